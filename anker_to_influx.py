@@ -1,13 +1,18 @@
 import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 from datetime import datetime, timedelta
+from functools import lru_cache
+import math
+import socket
 import time
 
 from aiohttp import ClientSession
 from api import api
 from dotenv import load_dotenv
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions
 
 load_dotenv()
 
@@ -20,6 +25,57 @@ INFLUX_URL = os.getenv("INFLUX_URL")
 INFLUX_TOKEN = os.getenv("INFLUX_TOKEN")
 INFLUX_ORG = os.getenv("INFLUX_ORG")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET")
+# Optional host:port of a UDP line protocol listener (e.g. Telegraf socket_listener) for power data,
+# it must forward into INFLUX_BUCKET since the daily stats are calculated from there. The relay
+# buffers samples (Telegraf flushes every 10 s by default), so daily stats then lag further behind.
+INFLUX_UDP_ADDRESS = os.getenv("INFLUX_UDP_ADDRESS")
+
+# Minimum seconds between background daily stats calculations
+STATS_INTERVAL = 60
+
+# site_name -> timestamp of the last written power record
+_last_timestamps = {}
+
+# Field layout of the written measurements
+_POWER_FIELDS = (
+    # Solar fields
+    "total_photovoltaic_power",
+    "solar_power_1",
+    "solar_power_2",
+    "solar_power_3",
+    "solar_power_4",
+    # Battery fields
+    "battery_percentage",
+    "battery_charge_power",
+    # Home and grid fields
+    "home_load_power",
+    "grid_to_home_power",
+    "photovoltaic_to_grid_power",
+    "to_home_load",
+    "ac_power",
+)
+_STATS_FIELDS = (
+    "daily_consumption_kwh",
+    "daily_generation_kwh",
+    "autarky_percent",
+    "self_consumption_percent",
+)
+# Power sample of a site, a flat tuple in _POWER_FIELDS order between name and timestamp
+PowerRecord = namedtuple("PowerRecord", ("site_name", *_POWER_FIELDS, "timestamp"))
+
+# Fields only written when non-zero, most devices have no third and fourth solar input
+_SKIP_ZERO_FIELDS = frozenset(("solar_power_3", "solar_power_4"))
+
+# Characters to escape in line protocol tag values
+_TAG_ESCAPE = str.maketrans({
+    "\\": "\\\\",
+    ",": "\\,",
+    "=": "\\=",
+    " ": "\\ ",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+})
 
 
 def calculate_daily_stats(client, site_name, current_timestamp):
@@ -30,48 +86,28 @@ def calculate_daily_stats(client, site_name, current_timestamp):
     start_time = datetime.fromtimestamp(current_timestamp).replace(hour=0, minute=0, second=0)
     start_timestamp = int(start_time.timestamp())
     
-    # Query for total consumption (home_load_power)
-    consumption_query = f'''
-    from(bucket: "{INFLUX_BUCKET}")
-        |> range(start: {start_timestamp})
-        |> filter(fn: (r) => r["_measurement"] == "anker_power")
-        |> filter(fn: (r) => r["site_name"] == "{site_name}")
-        |> filter(fn: (r) => r["_field"] == "home_load_power")
-        |> integral(unit: 1h)
-        |> yield(name: "daily_consumption")
-    '''
-    
-    # Query for total generation (total_photovoltaic_power)
-    generation_query = f'''
+    # Query consumption (home_load_power), generation (total_photovoltaic_power) and
+    # grid import (grid_to_home_power) at once, grouped per field and pivoted into a single row
+    stats_query = f'''
     from(bucket: "{INFLUX_BUCKET}")
         |> range(start: {start_timestamp})
-        |> filter(fn: (r) => r["_measurement"] == "anker_power")
-        |> filter(fn: (r) => r["site_name"] == "{site_name}")
-        |> filter(fn: (r) => r["_field"] == "total_photovoltaic_power")
+        |> filter(fn: (r) => r["_measurement"] == "anker_power" and r["site_name"] == "{site_name}")
+        |> filter(fn: (r) => r["_field"] == "home_load_power" or r["_field"] == "total_photovoltaic_power" or r["_field"] == "grid_to_home_power")
+        |> group(columns: ["_start", "_stop", "_field"])
         |> integral(unit: 1h)
-        |> yield(name: "daily_generation")
-    '''
-    
-    # Query for grid import (grid_to_home_power)
-    grid_import_query = f'''
-    from(bucket: "{INFLUX_BUCKET}")
-        |> range(start: {start_timestamp})
-        |> filter(fn: (r) => r["_measurement"] == "anker_power")
-        |> filter(fn: (r) => r["site_name"] == "{site_name}")
-        |> filter(fn: (r) => r["_field"] == "grid_to_home_power")
-        |> integral(unit: 1h)
-        |> yield(name: "grid_import")
+        |> group()
+        |> pivot(rowKey: ["_stop"], columnKey: ["_field"], valueColumn: "_value")
+        |> yield(name: "daily_stats")
     '''
     
     try:
-        consumption_result = query_api.query(org=INFLUX_ORG, query=consumption_query)
-        generation_result = query_api.query(org=INFLUX_ORG, query=generation_query)
-        grid_import_result = query_api.query(org=INFLUX_ORG, query=grid_import_query)
+        result = query_api.query(org=INFLUX_ORG, query=stats_query)
+        values = result[0].records[0].values if result and result[0].records else {}
         
-        # Extract values from results (default to 0 if no data)
-        daily_consumption = float(consumption_result[0].records[0].get_value() if consumption_result else 0.0)
-        daily_generation = float(generation_result[0].records[0].get_value() if generation_result else 0.0)
-        grid_import = float(grid_import_result[0].records[0].get_value() if grid_import_result else 0.0)
+        # Extract values from result (default to 0 if no data)
+        daily_consumption = float(values.get("home_load_power") or 0.0)
+        daily_generation = float(values.get("total_photovoltaic_power") or 0.0)
+        grid_import = float(values.get("grid_to_home_power") or 0.0)
         
         # Calculate self-consumed energy
         self_consumed = daily_consumption - grid_import
@@ -92,139 +128,250 @@ def calculate_daily_stats(client, site_name, current_timestamp):
         return None
 
 
-async def fetch_anker_data():
-    async with ClientSession() as web_session:
-        anker_api = api.AnkerSolixApi(
-            ANKER_EMAIL, ANKER_PASSWORD, ANKER_COUNTRY, web_session
-        )
+async def fetch_anker_data(anker_api):
+    await anker_api.update_sites()
+    power_data = []
+    
+    for site in anker_api.sites.values():
+        if 'solarbank_info' in site:
+            info = site['solarbank_info']
+            grid_info = site.get('grid_info', {})
+            
+            # Get battery info from first solarbank if available
+            battery_charge_power = 0.0
+            battery_percentage = 0.0
+            if info['solarbank_list']:
+                first_bank = info['solarbank_list'][0]
+                battery_charge_power = float(first_bank['charging_power'])
+                battery_percentage = float(first_bank['battery_power'])
 
-        await anker_api.update_sites()
-        power_data = []
-        
-        for site in anker_api.sites.values():
-            if 'solarbank_info' in site:
-                info = site['solarbank_info']
-                grid_info = site.get('grid_info', {})
-                
-                # Get battery info from first solarbank if available
-                battery_charge_power = 0.0
-                battery_percentage = 0.0
-                if info['solarbank_list']:
-                    first_bank = info['solarbank_list'][0]
-                    battery_charge_power = float(first_bank['charging_power'])
-                    battery_percentage = float(first_bank['battery_power'])
-
-                timestamp = parse_timestamp(info['updated_time'])
-
-                data = {
-                    'site_name': site['site_info']['site_name'],
-                    # Solar metrics
-                    'total_photovoltaic_power': float(info['total_photovoltaic_power']),
-                    'solar_power_1': float(info.get('solar_power_1', 0.0)),
-                    'solar_power_2': float(info.get('solar_power_2', 0.0)),
-                    'solar_power_3': float(info.get('solar_power_3', 0.0)),
-                    'solar_power_4': float(info.get('solar_power_4', 0.0)),
-                    # Battery metrics
-                    'battery_percentage': battery_percentage,
-                    'battery_charge_power': battery_charge_power,
-                    # Home and grid metrics
-                    'home_load_power': float(site.get('home_load_power', 0.0)),
-                    'grid_to_home_power': float(grid_info.get('grid_to_home_power', 0.0)),
-                    'photovoltaic_to_grid_power': float(grid_info.get('photovoltaic_to_grid_power', 0.0)),
-                    'to_home_load': float(info.get('to_home_load', 0.0)),
-                    'ac_power': float(info.get('ac_power', 0.0)),
-                    'timestamp': timestamp
-                }
-                power_data.append(data)
-
-                print(data)
-
-        return power_data
+            timestamp = parse_timestamp(info['updated_time'])
+
+            data = PowerRecord(
+                site_name=site['site_info']['site_name'],
+                # Solar metrics
+                total_photovoltaic_power=float(info['total_photovoltaic_power']),
+                solar_power_1=float(info.get('solar_power_1', 0.0)),
+                solar_power_2=float(info.get('solar_power_2', 0.0)),
+                solar_power_3=float(info.get('solar_power_3', 0.0)),
+                solar_power_4=float(info.get('solar_power_4', 0.0)),
+                # Battery metrics
+                battery_percentage=battery_percentage,
+                battery_charge_power=battery_charge_power,
+                # Home and grid metrics
+                home_load_power=float(site.get('home_load_power', 0.0)),
+                grid_to_home_power=float(grid_info.get('grid_to_home_power', 0.0)),
+                photovoltaic_to_grid_power=float(grid_info.get('photovoltaic_to_grid_power', 0.0)),
+                to_home_load=float(info.get('to_home_load', 0.0)),
+                ac_power=float(info.get('ac_power', 0.0)),
+                timestamp=timestamp
+            )
+            power_data.append(data)
+
+            print(data)
+
+    return power_data
+
+
+@lru_cache(maxsize=128)
+def _timestamp_from_string(timestamp_str):
+    """Convert 'YYYY-MM-DD HH:MM:SS' to Unix timestamp in seconds, slicing the fixed layout instead of strptime"""
+    if len(timestamp_str) == 19 and timestamp_str[4] == timestamp_str[7] == '-' and timestamp_str[10] == ' ':
+        dt = datetime(
+            int(timestamp_str[0:4]),
+            int(timestamp_str[5:7]),
+            int(timestamp_str[8:10]),
+            int(timestamp_str[11:13]),
+            int(timestamp_str[14:16]),
+            int(timestamp_str[17:19]),
+        )
+    else:
+        dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
+    return int(dt.timestamp())
 
 
 def parse_timestamp(timestamp_str):
     """Parse timestamp and convert to Unix timestamp in seconds"""
     try:
-        dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-        return int(dt.timestamp())
-    except ValueError:
+        return _timestamp_from_string(timestamp_str)
+    except (TypeError, ValueError):
         return int(datetime.now().timestamp())
 
 
-def write_to_influx(data):
-    client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-    write_api = client.write_api(write_options=SYNCHRONOUS)
+def _escape_tag(value):
+    """Escape tag value for line protocol"""
+    return str(value).translate(_TAG_ESCAPE)
 
-    try:
-        for site_data in data:
-            # Write power metrics
-            point = (
-                Point("anker_power")
-                .tag("site_name", site_data["site_name"])
-                # Solar fields
-                .field("total_photovoltaic_power", site_data["total_photovoltaic_power"])
-                .field("solar_power_1", site_data["solar_power_1"])
-                .field("solar_power_2", site_data["solar_power_2"])
-                .field("solar_power_3", site_data["solar_power_3"])
-                .field("solar_power_4", site_data["solar_power_4"])
-                # Battery fields
-                .field("battery_percentage", site_data["battery_percentage"])
-                .field("battery_charge_power", site_data["battery_charge_power"])
-                # Home and grid fields
-                .field("home_load_power", site_data["home_load_power"])
-                .field("grid_to_home_power", site_data["grid_to_home_power"])
-                .field("photovoltaic_to_grid_power", site_data["photovoltaic_to_grid_power"])
-                .field("to_home_load", site_data["to_home_load"])
-                .field("ac_power", site_data["ac_power"])
-                .time(site_data["timestamp"], WritePrecision.S)
+
+def _format_float(value):
+    """Format float field value for line protocol, None if it cannot be written"""
+    if not math.isfinite(value):
+        return None
+    text = repr(float(value))
+    # Line protocol floats do not need the trailing .0 of whole numbers
+    return text[:-2] if text.endswith(".0") else text
+
+
+def _to_line(measurement, site_name, field_keys, field_values, timestamp):
+    """Format fields with site_name tag and timestamp as line protocol, timestamp precision is up to the caller"""
+    fields = ",".join(
+        f"{key}={text}"
+        for key, value in zip(field_keys, field_values)
+        if not (key in _SKIP_ZERO_FIELDS and value == 0)
+        and (text := _format_float(value)) is not None
+    )
+    if not fields:
+        return None
+    # Empty tag values are invalid line protocol, omit the tag like Point does
+    tags = f",site_name={_escape_tag(site_name)}" if site_name else ""
+    return f"{measurement}{tags} {fields} {timestamp}"
+
+
+def write_lines(write_api, lines):
+    """Queue line protocol records, the batching writer flushes them in the background"""
+    if lines:
+        write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=lines, write_precision=WritePrecision.S)
+
+
+def open_udp_socket(address):
+    """Return UDP socket and target for given host:port"""
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"INFLUX_UDP_ADDRESS must be host:port, got '{address}'")
+    family, _, _, _, target = socket.getaddrinfo(host.strip("[]"), int(port), type=socket.SOCK_DGRAM)[0]
+    return socket.socket(family, socket.SOCK_DGRAM), target
+
+
+def write_to_influx(write_api, data, udp=None):
+    """Write power metrics and return the records of sites with a new sample"""
+    lines = []
+
+    # The Anker cloud refreshes less often than we poll, skip sites without a new sample
+    data = [record for record in data if _last_timestamps.get(record.site_name) != record.timestamp]
+
+    for record in data:
+        _last_timestamps[record.site_name] = record.timestamp
+        # Power fields are stored in _POWER_FIELDS order between site_name and timestamp
+        if udp:
+            # UDP listeners expect nanosecond timestamps, a lost datagram only drops one sample
+            udp_socket, target = udp
+            if line := _to_line("anker_power", record.site_name, _POWER_FIELDS, record[1:-1], record.timestamp * 1_000_000_000):
+                udp_socket.sendto(line.encode(), target)
+        elif line := _to_line("anker_power", record.site_name, _POWER_FIELDS, record[1:-1], record.timestamp):
+            lines.append(line)
+
+    write_lines(write_api, lines)
+    return data
+
+
+def daily_stats_lines(client, data):
+    """Calculate daily statistics for given power records and return them as line protocol"""
+    lines = []
+    if not data:
+        return lines
+
+    # Calculate daily statistics of all sites concurrently, each site needs a Flux query round-trip
+    with ThreadPoolExecutor(max_workers=len(data)) as executor:
+        all_stats = list(executor.map(
+            lambda record: calculate_daily_stats(client, record.site_name, record.timestamp),
+            data,
+        ))
+
+    for record, daily_stats in zip(data, all_stats):
+        if daily_stats:
+            stats = (
+                daily_stats["daily_consumption"] / 1000,  # Convert to kWh
+                daily_stats["daily_generation"] / 1000,   # Convert to kWh
+                daily_stats["autarky"],
+                daily_stats["self_consumption"],
             )
-            
-            write_api.write(
-                bucket=INFLUX_BUCKET,
-                org=INFLUX_ORG,
-                record=point
+            if line := _to_line("anker_daily_stats", record.site_name, _STATS_FIELDS, stats, record.timestamp):
+                lines.append(line)
+    return lines
+
+
+async def main():
+    start_time = time.time()
+    delay = 20
+    max_iterations = 3
+
+    # Keep one client and batching writer for the whole run so HTTP connections are reused
+    client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, enable_gzip=True)
+    write_api = client.write_api(
+        write_options=WriteOptions(
+            batch_size=500,
+            flush_interval=2_000,
+            jitter_interval=0,
+            retry_interval=1_000,
+        )
+    )
+
+    udp = None
+
+    # Daily stats run in the background so their Flux queries never delay the power writes
+    stats_executor = ThreadPoolExecutor(max_workers=1)
+    stats_future = None
+    stats_started = None
+
+    try:
+        # Send power data over UDP if configured, daily stats always use the HTTP writer
+        if INFLUX_UDP_ADDRESS:
+            udp = open_udp_socket(INFLUX_UDP_ADDRESS)
+
+        async with ClientSession() as web_session:
+            # Reuse the Api instance so login happens on the first request only
+            anker_api = api.AnkerSolixApi(
+                ANKER_EMAIL, ANKER_PASSWORD, ANKER_COUNTRY, web_session
             )
 
-            # Calculate and write daily statistics
-            daily_stats = calculate_daily_stats(client, site_data["site_name"], site_data["timestamp"])
-            if daily_stats:
-                stats_point = (
-                    Point("anker_daily_stats")
-                    .tag("site_name", site_data["site_name"])
-                    .field("daily_consumption_kwh", daily_stats["daily_consumption"] / 1000)  # Convert to kWh
-                    .field("daily_generation_kwh", daily_stats["daily_generation"] / 1000)    # Convert to kWh
-                    .field("autarky_percent", daily_stats["autarky"])
-                    .field("self_consumption_percent", daily_stats["self_consumption"])
-                    .time(site_data["timestamp"], WritePrecision.S)
-                )
-                write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=stats_point)
-                
+            for iteration in range(max_iterations):
+                try:
+                    data = await fetch_anker_data(anker_api)
+
+                    if data:
+                        written = write_to_influx(write_api, data, udp)
+                        if written:
+                            # The batching writer sends in the background and logs its own write errors
+                            print(f"✅ Data of {len(written)} site(s) queued for InfluxDB at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (iteration {iteration + 1}/{max_iterations})")
+                        else:
+                            print(f"No new data from Anker API since last write (iteration {iteration + 1}/{max_iterations})")
+
+                        # Calculate daily stats on the first iteration, then once per interval and on the
+                        # last iteration. Queries do not wait for the batching writer to flush, so the stats
+                        # may not include the power sample queued in the same iteration.
+                        last_iteration = iteration == max_iterations - 1
+                        if stats_future and (stats_future.done() or last_iteration):
+                            write_lines(write_api, await asyncio.wrap_future(stats_future))
+                            stats_future = None
+
+                        if written and stats_future is None and (
+                            stats_started is None
+                            or time.monotonic() - stats_started >= STATS_INTERVAL
+                            or last_iteration
+                        ):
+                            stats_future = stats_executor.submit(daily_stats_lines, client, written)
+                            stats_started = time.monotonic()
+                    else:
+                        print(f"No data received from Anker API (iteration {iteration + 1}/{max_iterations})")
+                except Exception as error:
+                    print(f"❌ Error: {str(error)}")
+
+                if iteration < max_iterations - 1:
+                    await asyncio.sleep(delay)
+
+            if stats_future:
+                write_lines(write_api, await asyncio.wrap_future(stats_future))
     finally:
+        # Flush pending points and release the connection pool even if the loop is interrupted
+        stats_executor.shutdown(cancel_futures=True)
+        if udp:
+            udp[0].close()
+        write_api.close()
         client.close()
 
+    elapsed = time.time() - start_time
+    print(f"Completed {max_iterations} iterations in {elapsed:.1f} seconds")
+
 
 if __name__ == "__main__":
-    start_time = time.time()
-    delay = 20
-    iterations = 0
-    max_iterations = 3
-    
-    while iterations < max_iterations:
-        try:
-            data = asyncio.run(fetch_anker_data())
-            
-            if data:
-                write_to_influx(data)
-                print(f"✅ Data successfully written to InfluxDB at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (iteration {iterations + 1}/{max_iterations})")
-            else:
-                print(f"No data received from Anker API (iteration {iterations + 1}/{max_iterations})")
-        except Exception as error:
-            print(f"❌ Error: {str(error)}")
-        finally:
-            iterations += 1
-            
-            if iterations < max_iterations:
-                time.sleep(delay)
-    
-    elapsed = time.time() - start_time
-    print(f"Completed {iterations} iterations in {elapsed:.1f} seconds")
\ No newline at end of file
+    asyncio.run(main())
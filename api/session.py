@@ -29,6 +29,12 @@ from .apitypes import (
 )
 from .helpers import RequestCounter, getTimezoneGMTString, md5
 
+try:
+    # use faster json decoder for responses if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 _LOGGER: logging.Logger = logging.getLogger(__name__)
 
 
@@ -454,7 +460,9 @@ class AnkerSolixClientSession:
                 body_text = await resp.text()
                 data = {}
                 resp.raise_for_status()  # any response status >= 400
-                if (data := await resp.json(content_type=None)) and self.encrypt_body:
+                if (
+                    data := await resp.json(content_type=None, loads=json_loads)
+                ) and self.encrypt_body:
                     # TODO(#70): Test and Support optional encryption for body
                     # data dict has to be decoded when encrypted
                     # if signature := data.get("signature"):